@@ -20,12 +20,21 @@ import os
 import sys
 import json
 import yaml
+import functools
 import plistlib
 import requests
 import subprocess
 from pathlib import Path
 from optparse import OptionParser
 from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Prefer the libyaml-backed loader when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 DEBUG = os.environ.get("DEBUG", False)
 SLACK_WEBHOOK = os.getenv("SLACK_WEBHOOK_URL")
@@ -35,6 +44,34 @@ JAMF_REPO = os.path.join(os.getenv("GITHUB_WORKSPACE", "/tmp/"), "jamf-repo")
 # Use an absolute overrides path so running from /tmp still finds recipe files
 OVERRIDES_DIR = os.path.join(os.getenv("GITHUB_WORKSPACE", os.getcwd()), "overrides")
 RECIPE_TO_RUN = os.environ.get("RECIPE", None)
+# Characters dropped or replaced when turning a recipe name into a branch name
+BRANCH_NAME_TABLE = str.maketrans({" ": None, "(": "-", ")": "-"})
+
+# One session for the whole run so each recipe's Slack alert reuses the same
+# TLS connection instead of opening a new one.
+#
+# Retry policy for the webhook POST (opted in via allowed_methods, since
+# urllib3 doesn't retry POST by default):
+# - connect errors are retried; nothing has reached Slack yet
+# - a 503 is retried with backoff
+# - read errors, 502 and 504 are not retried, since Slack may already have
+#   posted the alert and a retry would duplicate it
+# Once retries run out the last response is returned rather than raised, so
+# slack_alert can still report the status code and body.
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        max_retries=Retry(
+            total=3,
+            read=0,
+            backoff_factor=0.5,
+            status_forcelist=[503],
+            allowed_methods=["POST"],
+            raise_on_status=False,
+        ),
+    ),
+)
 
 class Recipe(object):
     def __init__(self, path):
@@ -51,7 +88,7 @@ class Recipe(object):
     def yaml(self):
         if self._keys is None:
             with open(self.path, "rb") as f:
-                self._keys = yaml.safe_load(f)
+                self._keys = yaml.load(f, Loader=YamlLoader)
 
         return self._keys
 
@@ -60,9 +97,7 @@ class Recipe(object):
         return (
             "{}_{}".format(self.name, self.updated_version)
             .strip()
-            .replace(" ", "")
-            .replace(")", "-")
-            .replace("(", "-")
+            .translate(BRANCH_NAME_TABLE)
         )
 
     @property
@@ -172,7 +207,7 @@ class Recipe(object):
 
 
 ### GIT FUNCTIONS
-def git_run(cmd):
+def git_run(cmd, capture=False):
     cmd = ["git"] + cmd
     hide_cmd_output = True
 
@@ -182,15 +217,51 @@ def git_run(cmd):
 
     try:
         result = subprocess.run(
-            " ".join(cmd), shell=True, cwd=JAMF_REPO, capture_output=hide_cmd_output
+            " ".join(cmd),
+            shell=True,
+            cwd=JAMF_REPO,
+            capture_output=hide_cmd_output or capture,
         )
     except subprocess.CalledProcessError as e:
         print(e.stderr)
         raise e
 
+    return result
+
+
+def stage_paths(paths):
+    # Try staging everything with a single git invocation first
+    result = git_run(["add"] + paths)
+    if result.returncode == 0:
+        return True
+
+    # A single bad pathspec makes the batched add stage nothing, so retry
+    # each path on its own and report the ones that still fail
+    staged_all = True
+    for path in paths:
+        if git_run(["add", path]).returncode != 0:
+            print(f"Failed to stage {path}")
+            staged_all = False
+    return staged_all
+
+
+def has_staged_changes():
+    # Exit code 1 means the index differs from HEAD; this only reads the
+    # index, unlike `git status`, which also scans the worktree
+    result = git_run(["diff", "--cached", "--quiet"])
+    if result.returncode not in (0, 1):
+        # Log and carry on like the other git helpers so one broken repo
+        # state doesn't stop the remaining recipes and trust-info output
+        print(f"git diff --cached failed with exit code {result.returncode}")
+        if result.stderr:
+            print(result.stderr.decode())
+        return False
+    return result.returncode == 1
+
 
 def current_branch():
-    git_run(["rev-parse", "--abbrev-ref", "HEAD"])
+    result = git_run(["rev-parse", "--abbrev-ref", "HEAD"], capture=True)
+    return result.stdout.decode().strip()
 
 
 def checkout(branch, new=True):
@@ -222,17 +293,21 @@ def handle_recipe(recipe, opts):
         recipe.run()
         if recipe.results["imported"]:
             checkout(recipe.branch)
+            paths = []
             for imported in recipe.results["imported"]:
-                git_run(["add", f"'pkgs/{ imported['pkg_repo_path'] }'"])
-                git_run(["add", f"'pkgsinfo/{ imported['pkginfo_path'] }'"])
-            git_run(
-                [
-                    "commit",
-                    "-m",
-                    f"'Updated { recipe.name } to { recipe.updated_version }'",
-                ]
-            )
-            git_run(["push", "--set-upstream", "origin", recipe.branch])
+                paths.append(f"'pkgs/{ imported['pkg_repo_path'] }'")
+                paths.append(f"'pkgsinfo/{ imported['pkginfo_path'] }'")
+            if not stage_paths(paths):
+                print(f"Some files for { recipe.name } could not be staged")
+            if has_staged_changes():
+                git_run(
+                    [
+                        "commit",
+                        "-m",
+                        f"'Updated { recipe.name } to { recipe.updated_version }'",
+                    ]
+                )
+                git_run(["push", "--set-upstream", "origin", recipe.branch])
     return recipe
 
 
@@ -253,7 +328,7 @@ def parse_recipes(recipes):
         elif ext == ".plist":
             parser = plistlib.load
         elif ext == ".yaml":
-            parser = yaml.safe_load
+            parser = functools.partial(yaml.load, Loader=YamlLoader)
         else:
             print(
                 f'Invalid run list extension "{ ext }" (expected plist or json or yaml)'
@@ -274,8 +349,9 @@ def import_icons():
         "/usr/local/jamf/iconimporter jamf-repo", shell=True
     )
     git_run(["add", "icons/"])
-    git_run(["commit", "-m", "Added new icons"])
-    git_run(["push", "--set-upstream", "origin", f"{branch_name}"])
+    if has_staged_changes():
+        git_run(["commit", "-m", "Added new icons"])
+        git_run(["push", "--set-upstream", "origin", f"{branch_name}"])
 
 
 def slack_alert(recipe, opts):
@@ -307,7 +383,7 @@ def slack_alert(recipe, opts):
         # Also no updates
         return
 
-    response = requests.post(
+    response = SESSION.post(
         SLACK_WEBHOOK,
         data=json.dumps(
             {
@@ -324,6 +400,7 @@ def slack_alert(recipe, opts):
             }
         ),
         headers={"Content-Type": "application/json"},
+        timeout=30,
     )
     if response.status_code != 200:
         raise ValueError(